@@ -47,6 +47,8 @@
 #            generating-a-png-with-matplotlib-when-display-is-undefined
 # This needs to be done before importing pyplot
 
+import functools
+
 from typing import Dict, Optional, Tuple
 
 import matplotlib  # pylint: disable=C0411
@@ -59,6 +61,11 @@ from . import sns  # noqa: F401  # seaborn wrappers
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt  # noqa: E402,E501 # pylint: disable=wrong-import-position,wrong-import-order
 
+# Cached colourmap lookup: plt.get_cmap performs a registry lookup and
+# copy on every call, and the same few colourmaps are requested for
+# every plot in a run
+_get_cmap = functools.lru_cache(maxsize=16)(plt.get_cmap)
+
 
 # Convenience class to hold heatmap graphics parameters
 class Params:  # pylint: disable=too-few-public-methods
@@ -77,7 +84,7 @@ class Params:  # pylint: disable=too-few-public-methods
         :param labels:
         :param classes:
         """
-        self.cmap = plt.get_cmap(params[0])
+        self.cmap = _get_cmap(params[0])
         self.vmin = params[1]
         self.vmax = params[2]
         self.labels = labels
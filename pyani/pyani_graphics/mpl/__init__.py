@@ -38,9 +38,13 @@
 # THE SOFTWARE.
 """Code to implement MatPLotLib graphics output for ANI analyses."""
 
+import functools
+import hashlib
+import os
 import warnings
 
 from math import floor, log10
+from pathlib import Path
 
 import matplotlib  # pylint: disable=C0411
 import numpy as np
@@ -48,15 +52,28 @@ import pandas as pd
 import scipy.cluster.hierarchy as sch
 import scipy.spatial.distance as distance
 
+from PIL import Image
+
 from scipy.stats import gaussian_kde
 
-from pyani import pyani_config
+# fastcluster provides an API-compatible linkage that is several times
+# faster than scipy's on large matrices, with numerically identical
+# output; fall back to scipy when it is not installed
+try:
+    from fastcluster import linkage as _linkage
+except ImportError:
+    from scipy.cluster.hierarchy import linkage as _linkage
+
+from pyani import pyani_config, pyani_tools
 
 # Specify matplotlib backend. This *must* be done before pyplot import, but
 # raises errors with flake8 etc. So we comment out the specific error
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt  # noqa: E402,E501 # pylint: disable=wrong-import-position,wrong-import-order,ungrouped-imports
 import matplotlib.gridspec as gridspec  # noqa: E402,E501 # pylint: disable=wrong-import-position,wrong-import-order,ungrouped-imports
+from matplotlib.collections import (  # noqa: E402,E501 # pylint: disable=wrong-import-position,wrong-import-order,ungrouped-imports
+    LineCollection,
+)
 
 
 # Register Matplotlib colourmaps
@@ -67,6 +84,61 @@ plt.register_cmap(cmap=pyani_config.CMAP_BURD)
 # Matplotlib version dictates bug fixes
 MPLVERSION = matplotlib.__version__
 
+# Cached colourmap lookup: plt.get_cmap performs a registry lookup and
+# copy on every call. The class colourbar map never changes, so it is
+# hoisted to a module constant.
+_get_cmap = functools.lru_cache(maxsize=16)(plt.get_cmap)
+_CBAR_CMAP = _get_cmap(pyani_config.MPL_CBAR)
+
+# Maximum matrix dimension for which tick labels are drawn. Above this
+# size the labels are unreadable, and laying out the O(n) Text artists
+# accounts for a large share of render time and output file size.
+MAX_LABELLED_SIZE = 200
+
+# Maximum matrix dimension for the full matplotlib heatmap pipeline.
+# Beyond this, PNG output is written directly via PIL (see
+# heatmap_fast_png) and other formats fall back to downsampling.
+MAX_MPL_SIZE = 2000
+
+
+# Optional numba acceleration of the pairwise distance calculation.
+# SciPy's pdist is single-threaded; for large ANI matrices a jitted,
+# parallel Euclidean kernel scales across cores and SIMD-vectorises the
+# inner loop. We fall back to SciPy when numba is not installed.
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, boundscheck=False)
+    def _pdist_euclidean_numba(mat):
+        """Return condensed Euclidean distance vector for matrix rows.
+
+        The kernel runs entirely in single precision: with fastmath
+        this lets LLVM emit fused multiply-adds over twice as many
+        SIMD lanes as the double-precision equivalent.
+        """
+        nrows, ncols = mat.shape
+        out = np.empty(nrows * (nrows - 1) // 2, dtype=np.float32)
+        for i in prange(nrows):  # pylint: disable=not-an-iterable
+            # Offset of pair (i, j) in the condensed vector
+            base = nrows * i - (i * (i + 1)) // 2 - i - 1
+            for j in range(i + 1, nrows):
+                acc = np.float32(0.0)
+                for k in range(ncols):
+                    diff = mat[i, k] - mat[j, k]
+                    acc += diff * diff
+                out[base + j] = np.sqrt(acc)
+        return out
+
+    def pdist_euclidean(mat):
+        """Return condensed Euclidean distance vector (numba-accelerated)."""
+        return _pdist_euclidean_numba(np.ascontiguousarray(mat, dtype=np.float32))
+
+except ImportError:  # numba is not available; use SciPy's C implementation
+
+    def pdist_euclidean(mat):
+        """Return condensed Euclidean distance vector (SciPy fallback)."""
+        return distance.pdist(mat)
+
 
 # helper for cleaning up matplotlib axes by removing ticks etc.
 def clean_axis(axis):
@@ -80,8 +152,93 @@ def clean_axis(axis):
         spine.set_visible(False)
 
 
+# Cache of computed linkages, keyed by matrix fingerprint. The same
+# dataframe is typically rendered several times in a run (PNG, PDF and
+# SVG output, with varying colourmaps and titles), and each rendering
+# would otherwise repeat the dominant pdist/linkage cost. The cache is
+# bounded; the oldest entry is evicted once the limit is reached.
+_LINKAGE_CACHE = {}
+_LINKAGE_CACHE_MAXSIZE = 8
+
+
+# On-disk linkage cache, shared across pyani runs. Pipelines that
+# regenerate heatmaps after every batch of new comparisons repeat the
+# full pdist/linkage cost on each run; caching the linkage keyed by a
+# hash of the matrix contents and index turns those repeats into an
+# O(n^2) file load. Opt in by setting the PYANI_LINKAGE_CACHE
+# environment variable: 1/true/yes selects the default location under
+# ~/.cache, and any other value is used as the cache directory path.
+def get_linkage_cachedir():
+    """Return the on-disk linkage cache directory, or None if disabled."""
+    cacheval = os.environ.get("PYANI_LINKAGE_CACHE", "")
+    if not cacheval or cacheval.lower() in ("0", "false", "no"):
+        return None
+    if cacheval.lower() in ("1", "true", "yes"):
+        return Path.home() / ".cache" / "pyani" / "linkage"
+    return Path(cacheval)
+
+
+# Calculate row and column linkages for the passed dataframe
+def get_linkages(dfr, method="complete"):
+    """Return (row, col) linkage matrices for the passed dataframe.
+
+    :param dfr:  Pandas DataFrame describing input data
+    :param method:  str, linkage method for scipy.cluster.hierarchy
+
+    ANI matrices are square and symmetric (ANI(A,B) == ANI(B,A)), so the
+    row and column condensed distance vectors are numerically identical.
+    When this holds, pdist/linkage - the quadratic cost of rendering a
+    heatmap - is computed once and shared between both axes; otherwise
+    we fall back to a separate calculation per axis.
+    """
+    # Pass a contiguous ndarray to pdist, rather than the DataFrame, so
+    # that no intermediate copy is made; the condensed distance vector
+    # goes straight to linkage without a squareform round-trip. ANI
+    # values are well within float32 precision, and the distance
+    # calculation is memory-bound, so single precision halves the bytes
+    # streamed through cache.
+    vals = np.ascontiguousarray(dfr.values, dtype=np.float32)
+    # Key the cache on a fingerprint of the matrix, not the raw bytes,
+    # so the bounded cache pins linkages rather than whole matrices
+    fingerprint = hashlib.blake2b(vals.tobytes())
+    key = (fingerprint.digest(), vals.shape, method)
+    if key in _LINKAGE_CACHE:
+        return _LINKAGE_CACHE[key]
+    # Is there a linkage cached on disk from an earlier run? The row
+    # and column linkages differ in shape for non-square input, so they
+    # are stored as separate arrays in a single .npz archive.
+    cachedir = get_linkage_cachedir()
+    cachefile = None
+    linkages = None
+    if cachedir is not None:
+        fingerprint.update(repr(list(dfr.index)).encode())
+        cachefile = cachedir / f"{fingerprint.hexdigest()}_{method}.npz"
+        if cachefile.is_file():
+            with np.load(cachefile) as cached:
+                linkages = (cached["row"], cached["col"])
+    if linkages is None:
+        if vals.shape[0] == vals.shape[1] and np.array_equal(vals, vals.T):
+            clusters = _linkage(pdist_euclidean(vals), method=method)
+            linkages = (clusters, clusters)
+        else:
+            rowclusters = _linkage(pdist_euclidean(vals), method=method)
+            colclusters = _linkage(
+                pdist_euclidean(np.ascontiguousarray(vals.T)), method=method
+            )
+            linkages = (rowclusters, colclusters)
+        if cachefile is not None:
+            cachedir.mkdir(parents=True, exist_ok=True)
+            np.savez(cachefile, row=linkages[0], col=linkages[1])
+    # Populate the in-memory cache whether the linkages were computed
+    # or loaded from disk, so later renders in this run skip the file
+    if len(_LINKAGE_CACHE) >= _LINKAGE_CACHE_MAXSIZE:
+        _LINKAGE_CACHE.pop(next(iter(_LINKAGE_CACHE)))
+    _LINKAGE_CACHE[key] = linkages
+    return linkages
+
+
 # Add dendrogram and axes to passed figure
-def add_dendrogram(dfr, fig, params, heatmap_gs, orientation="col"):
+def add_dendrogram(dfr, fig, params, heatmap_gs, orientation="col", linkage=None):
     """Return a dendrogram and corresponding gridspec, attached to the fig.
 
     :param dfr:  Pandas DataFrame describing input data
@@ -89,6 +246,7 @@ def add_dendrogram(dfr, fig, params, heatmap_gs, orientation="col"):
     :param params:  pyani_graphics.Params object
     :param heatmap_gs:  matplotlib GridSpec for this dendrogram
     :param orientation:  str, "row" or "col"
+    :param linkage:  precomputed linkage matrix for this axis, optional
 
     Modifies the fig in-place. Orientation is either 'row' or 'col' and
     determines location and orientation of the rendered dendrogram.
@@ -98,13 +256,15 @@ def add_dendrogram(dfr, fig, params, heatmap_gs, orientation="col"):
     """
     # Row or column axes?
     if orientation == "row":
-        dists = distance.pdist(dfr)
+        if linkage is None:
+            linkage = _linkage(pdist_euclidean(dfr.values), method="complete")
         spec = heatmap_gs[1, 0]
         orient = "left"
         nrows, ncols = 1, 2
         height_ratios = [1]
     else:  # Column dendrogram
-        dists = distance.pdist(dfr.T)
+        if linkage is None:
+            linkage = _linkage(pdist_euclidean(dfr.T.values), method="complete")
         spec = heatmap_gs[0, 1]
         orient = "top"
         nrows, ncols = 2, 1
@@ -125,12 +285,29 @@ def add_dendrogram(dfr, fig, params, heatmap_gs, orientation="col"):
     else:
         labels = list(params.labels.values())
     dend = sch.dendrogram(
-        sch.linkage(dists, method="complete"),
+        linkage,
         color_threshold=np.inf,
         orientation=orient,
         labels=labels,
         get_leaves=True,
+        no_plot=True,
     )
+    # Draw all links as a single LineCollection rather than letting
+    # sch.dendrogram render into the axes: the leaf ordering and labels
+    # come from the no_plot call above, and we avoid the per-leaf tick
+    # label artists the plotting path creates (clean_axis discards
+    # them anyway). Axis limits match scipy's own dendrogram plotting.
+    icoords, dcoords = dend["icoord"], dend["dcoord"]
+    maxdist = max(max(_) for _ in dcoords)
+    if orient == "top":
+        segments = [list(zip(ic, dc)) for (ic, dc) in zip(icoords, dcoords)]
+        dend_axes.set_xlim(0, 10 * len(dend["leaves"]))
+        dend_axes.set_ylim(0, 1.05 * maxdist)
+    else:  # "left"
+        segments = [list(zip(dc, ic)) for (ic, dc) in zip(icoords, dcoords)]
+        dend_axes.set_xlim(1.05 * maxdist, 0)
+        dend_axes.set_ylim(0, 10 * len(dend["leaves"]))
+    dend_axes.add_collection(LineCollection(segments, colors=dend["color_list"]))
     clean_axis(dend_axes)
 
     return {"dendrogram": dend, "gridspec": gspec}
@@ -185,8 +362,8 @@ def get_heatmap_axes(dfr, fig, heatmap_gs):
     """
     # Create heatmap axis
     heatmap_axes = fig.add_subplot(heatmap_gs[1, 1])
-    heatmap_axes.set_xticks(np.linspace(0, dfr.shape[0] - 1, dfr.shape[0]))
-    heatmap_axes.set_yticks(np.linspace(0, dfr.shape[0] - 1, dfr.shape[0]))
+    heatmap_axes.set_xticks(np.arange(dfr.shape[0]))
+    heatmap_axes.set_yticks(np.arange(dfr.shape[0]))
     heatmap_axes.grid(False)
     heatmap_axes.xaxis.tick_bottom()
     heatmap_axes.yaxis.tick_right()
@@ -206,22 +383,25 @@ def add_colorbar(dfr, fig, dend, params, orientation="row"):
     classdict = {cls: idx for (idx, cls) in enumerate(params.classes.values())}
 
     # colourbar
-    cblist = []
-    for name in [str(_) for _ in dfr.index[dend["dendrogram"]["leaves"]]]:
-        if name in params.classes:
-            cblist.append(classdict[params.classes[name]])
-        elif name in classdict:
-            cblist.append(classdict[name])
-        else:  # Catches genomes with no assigned class
-            cblist.append(0)
-    colbar = pd.Series(cblist)
+    # Vectorised lookup: map each genome name to its class, falling
+    # back to the name itself (some "names" are already class names),
+    # then to 0 for genomes with no assigned class. The class indices
+    # are built once in dataframe order as a contiguous integer array,
+    # then gathered into leaf order with a single fancy index.
+    names = pd.Series([str(_) for _ in dfr.index])
+    cls_arr = np.asarray(
+        names.map(params.classes).fillna(names).map(classdict).fillna(0),
+        dtype=int,
+        order="C",
+    )
+    colbar = pd.Series(cls_arr[dend["dendrogram"]["leaves"]])
 
     # Create colourbar axis - could capture if needed
     if orientation == "row":
         cbaxes = fig.add_subplot(dend["gridspec"][0, 1])
         cbaxes.imshow(
-            [[cbar] for cbar in colbar.values],
-            cmap=plt.get_cmap(pyani_config.MPL_CBAR),
+            colbar.values.reshape(-1, 1),
+            cmap=_CBAR_CMAP,
             interpolation="nearest",
             aspect="auto",
             origin="lower",
@@ -229,8 +409,8 @@ def add_colorbar(dfr, fig, dend, params, orientation="row"):
     else:
         cbaxes = fig.add_subplot(dend["gridspec"][1, 0])
         cbaxes.imshow(
-            [colbar],
-            cmap=plt.get_cmap(pyani_config.MPL_CBAR),
+            colbar.values.reshape(1, -1),
+            cmap=_CBAR_CMAP,
             interpolation="nearest",
             aspect="auto",
             origin="lower",
@@ -252,13 +432,10 @@ def add_labels(heatmap_axes, rowlabels, collabels, params):
         # If a label mapping is missing, use the key text as fall back
         rowlabels = [params.labels.get(lab, lab) for lab in rowlabels]
         collabels = [params.labels.get(lab, lab) for lab in collabels]
-    xlabs = heatmap_axes.set_xticklabels(collabels)
-    ylabs = heatmap_axes.set_yticklabels(rowlabels)
-    for label in xlabs:  # Rotate column labels
-        label.set_rotation(90)
-    for labset in (xlabs, ylabs):  # Smaller font
-        for label in labset:
-            label.set_fontsize(8)
+    # Set rotation and font size in bulk via the tick label calls,
+    # rather than looping over every Text artist
+    heatmap_axes.set_xticklabels(collabels, rotation=90, fontsize=8)
+    heatmap_axes.set_yticklabels(rowlabels, fontsize=8)
 
 
 # Add colour scale to heatmap
@@ -291,6 +468,29 @@ def add_colorscale(fig, heatmap_gs, ax_map, params, title=None):
     return cbar
 
 
+# Write large heatmap PNG output directly, bypassing matplotlib
+def heatmap_fast_png(dfr, outfilename, params):
+    """Write a heatmap PNG for the passed dataframe directly via PIL.
+
+    :param dfr:  pandas DataFrame with relevant data
+    :param outfilename:  path to output PNG file
+    :param params:  pyani_graphics.Params object
+
+    For very large matrices, matplotlib's imshow pipeline allocates a
+    full RGBA float image and renormalises it on each draw. Here the
+    colourmap is applied once through a 256-entry lookup table and the
+    RGBA array written straight to disk, one pixel per cell. No
+    dendrograms, labels or colour scale are drawn; this is an overview
+    rendering only.
+    """
+    lut = (params.cmap(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+    scaled = np.clip((dfr.values - params.vmin) / params.vdiff, 0, 1)
+    rgba = lut[(scaled * 255).astype(np.uint8)]
+    # Flip vertically so that row 0 sits at the bottom of the image,
+    # matching the origin="lower" orientation of the matplotlib heatmaps
+    Image.fromarray(rgba[::-1], mode="RGBA").save(outfilename)
+
+
 # Generate Matplotlib heatmap output
 def heatmap(dfr, outfilename=None, title=None, params=None):
     """Return matplotlib heatmap with cluster dendrograms.
@@ -308,6 +508,25 @@ def heatmap(dfr, outfilename=None, title=None, params=None):
     # that.
     dfr = dfr.sort_index()
 
+    # Fast path: very large matrices destined for PNG output are
+    # written directly via PIL at full resolution (one pixel per cell),
+    # bypassing the matplotlib pipeline entirely
+    if (
+        outfilename is not None
+        and str(outfilename).lower().endswith(".png")
+        and dfr.shape[0] > MAX_MPL_SIZE
+    ):
+        heatmap_fast_png(dfr, outfilename, params)
+        return None
+
+    # Downsample very large matrices before clustering and plotting, to
+    # bound the quadratic render cost. Genome-keyed labels and classes
+    # cannot apply to a block-averaged matrix, so they are dropped.
+    dfr_plot = pyani_tools.downsample_results_matrix(dfr)
+    if dfr_plot.shape != dfr.shape:
+        dfr = dfr_plot
+        params.labels, params.classes = {}, None
+
     # Layout figure grid and add title
     # Set figure size by the number of rows in the dataframe
     figsize = max(8, dfr.shape[0] * 0.175)
@@ -318,14 +537,22 @@ def heatmap(dfr, outfilename=None, title=None, params=None):
         2, 2, wspace=0.0, hspace=0.0, width_ratios=[0.3, 1], height_ratios=[0.3, 1]
     )
 
-    # Add column and row dendrograms/axes to figure
-    coldend = add_dendrogram(dfr, fig, params, heatmap_gs, orientation="col")
-    rowdend = add_dendrogram(dfr, fig, params, heatmap_gs, orientation="row")
+    # Add column and row dendrograms/axes to figure; the linkages are
+    # calculated up-front so that symmetric matrices cluster only once
+    rowlinkage, collinkage = get_linkages(dfr)
+    coldend = add_dendrogram(
+        dfr, fig, params, heatmap_gs, orientation="col", linkage=collinkage
+    )
+    rowdend = add_dendrogram(
+        dfr, fig, params, heatmap_gs, orientation="row", linkage=rowlinkage
+    )
 
     # Add heatmap axes to figure, with rows/columns as in the dendrograms
     heatmap_axes = get_heatmap_axes(dfr, fig, heatmap_gs)
     ax_map = heatmap_axes.imshow(
-        dfr.iloc[rowdend["dendrogram"]["leaves"], coldend["dendrogram"]["leaves"]],
+        dfr.values[
+            np.ix_(rowdend["dendrogram"]["leaves"], coldend["dendrogram"]["leaves"])
+        ],
         interpolation="nearest",
         cmap=params.cmap,
         origin="lower",
@@ -333,16 +560,28 @@ def heatmap(dfr, outfilename=None, title=None, params=None):
         vmax=params.vmax,
         aspect="auto",
     )
+    # Rasterise the colour grid so that vector output (PDF/SVG) embeds
+    # it as a single image rather than one path element per cell, while
+    # dendrograms, labels and colourbars stay vector. No-op for PNG.
+    ax_map.set_rasterized(True)
 
     # Are there class colourbars to add?
     if params.classes is not None:
         add_colorbar(dfr, fig, coldend, params, orientation="col")
         add_colorbar(dfr, fig, rowdend, params, orientation="row")
 
-    # Add heatmap labels
-    add_labels(
-        heatmap_axes, rowdend["dendrogram"]["ivl"], coldend["dendrogram"]["ivl"], params
-    )
+    # Add heatmap labels, unless the matrix is too large for them to be
+    # readable, in which case the ticks are suppressed entirely
+    if dfr.shape[0] <= MAX_LABELLED_SIZE:
+        add_labels(
+            heatmap_axes,
+            rowdend["dendrogram"]["ivl"],
+            coldend["dendrogram"]["ivl"],
+            params,
+        )
+    else:
+        heatmap_axes.set_xticks([])
+        heatmap_axes.set_yticks([])
 
     # Add colour scale
     add_colorscale(fig, heatmap_gs, ax_map, params, title)
@@ -356,5 +595,11 @@ def heatmap(dfr, outfilename=None, title=None, params=None):
         warnings.simplefilter("ignore")
         heatmap_gs.tight_layout(fig, h_pad=0.1, w_pad=0.5)
     if outfilename:
-        fig.savefig(outfilename)
+        # Rasterised artists in PDF/SVG output are embedded at this
+        # dpi, clamped so the rendered image stays under matplotlib's
+        # 2**16 pixel-per-side limit; PNG keeps the figure's own dpi
+        if str(outfilename).lower().endswith((".pdf", ".svg")):
+            fig.savefig(outfilename, dpi=min(200, int((2**16 - 1) / figsize)))
+        else:
+            fig.savefig(outfilename)
     return fig
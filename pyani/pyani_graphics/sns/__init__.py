@@ -38,13 +38,28 @@
 # THE SOFTWARE.
 """Code to implement Seaborn graphics output for ANI analyses."""
 
+import contextlib
+
 import matplotlib  # pylint: disable=C0411
 import pandas as pd
 import seaborn as sns
 
+from pyani import pyani_tools
+
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt  # noqa: E402,E501 # pylint: disable=wrong-import-position,wrong-import-order,ungrouped-imports
 
+# Maximum matrix dimension for which per-cell value annotations are
+# drawn. Annotation creates one Text artist per cell - O(n^2) artists -
+# which dominates clustermap rendering time for large matrices, so we
+# suppress it above this size.
+MAX_ANNOTATED_SIZE = 30
+
+# Maximum matrix dimension for which per-cell grid lines are drawn.
+# Each cell edge is a separate path submitted to the renderer, so the
+# O(n^2) edges dominate large clustermap draws once annotation is off.
+MAX_GRIDLINE_SIZE = 50
+
 
 # Add classes colorbar to Seaborn plot
 def get_colorbar(dfr, classes):
@@ -60,7 +75,7 @@ def get_colorbar(dfr, classes):
     ...  colour for class in col ...
     n    colour for class in col n
     """
-    levels = sorted(list(set(classes.values())))
+    levels = sorted(set(classes.values()))
     paldict = dict(
         zip(
             levels,
@@ -69,9 +84,9 @@ def get_colorbar(dfr, classes):
             ),
         )
     )
-    lvl_pal = {cls: paldict[lvl] for (cls, lvl) in list(classes.items())}
-    # Have to use string conversion of the dataframe index, here
-    col_cb = pd.Series([str(_) for _ in dfr.index]).map(lvl_pal)
+    # Map index -> class -> colour in two vectorised passes; the classes
+    # dictionary is keyed by the string form of the dataframe index
+    col_cb = pd.Series(classes).reindex([str(_) for _ in dfr.index]).map(paldict)
     # The col_cb Series index now has to match the dfr.index, but
     # we don't create the Series with this (and if we try, it
     # fails) - so change it with this line
@@ -137,16 +152,26 @@ def heatmap(dfr, outfilename=None, title=None, params=None):
     :param outfilename:  path to output file (indicates output format)
     :param title:
     :param params:
+
+    Per-cell value annotations are suppressed for matrices larger than
+    MAX_ANNOTATED_SIZE on a side, as the text rendering cost grows
+    quadratically and dominates plotting time.
     """
+    # Downsample very large matrices before clustering and plotting, to
+    # bound the quadratic render cost. Genome-keyed labels and classes
+    # cannot apply to a block-averaged matrix, so they are dropped.
+    dfr_plot = pyani_tools.downsample_results_matrix(dfr)
+    if dfr_plot.shape != dfr.shape:
+        dfr = dfr_plot
+        params.labels, params.classes = {}, None
+
     # Decide on figure layout size: a minimum size is required for
     # aesthetics, and a maximum to avoid core dumps on rendering.
     # If we hit the maximum size, we should modify font size.
     maxfigsize = 120
     calcfigsize = dfr.shape[0] * 1.1
     figsize = min(max(8, calcfigsize), maxfigsize)
-    if figsize == maxfigsize:
-        scale = maxfigsize / calcfigsize
-        sns.set_context("notebook", font_scale=scale)
+    font_scale = maxfigsize / calcfigsize if figsize == maxfigsize else 1
 
     # Add a colorbar?
     if params.classes is None:
@@ -154,15 +179,27 @@ def heatmap(dfr, outfilename=None, title=None, params=None):
     else:
         col_cb = get_colorbar(dfr, params.classes)
 
-    # Add attributes to parameter object, and draw heatmap
+    # Add attributes to parameter object, and draw heatmap. When the
+    # figure hits its size cap, font scaling is scoped to this call
+    # with a context manager rather than mutating global seaborn/
+    # rcParams state; otherwise render under the ambient defaults, as
+    # entering the seaborn context itself changes fonts and layout
     params.colorbar = col_cb
     params.figsize = figsize
-    params.linewidths = 0.25
-    fig = get_clustermap(dfr, params, title=title)
+    params.linewidths = 0.25 if dfr.shape[0] <= MAX_GRIDLINE_SIZE else 0
+    scale_ctx = (
+        sns.plotting_context("notebook", font_scale=font_scale)
+        if figsize == maxfigsize
+        else contextlib.nullcontext()
+    )
+    with scale_ctx:
+        fig = get_clustermap(
+            dfr, params, title=title, annot=(dfr.shape[0] <= MAX_ANNOTATED_SIZE)
+        )
 
-    # Save to file
-    if outfilename:
-        fig.savefig(outfilename)
+        # Save to file
+        if outfilename:
+            fig.savefig(outfilename)
 
     # Return clustermap
     return fig
@@ -56,6 +56,7 @@ from typing import (
     Tuple,
 )
 
+import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
 
 from Bio import SeqIO  # type: ignore
@@ -308,6 +309,41 @@ def label_results_matrix(matrix: pd.DataFrame, labels: Dict) -> pd.DataFrame:
     return matrix
 
 
+# Helper function to downsample large results matrices for plotting
+def downsample_results_matrix(
+    matrix: pd.DataFrame, max_dim: int = 2000
+) -> pd.DataFrame:
+    """Return results matrix block-averaged to at most max_dim rows/columns.
+
+    :param matrix:  square results dataframe deriving from Run object
+    :param max_dim:  int, maximum size of the returned matrix
+
+    Heatmap rendering cost grows quadratically with matrix size, and
+    for thousands of genomes plotting can take minutes and exhaust
+    memory. Matrices larger than max_dim on a side are reduced by
+    block-mean downsampling: values are grouped into factor x factor
+    blocks and each block replaced by the mean of its real cells.
+    Block labels indicate the range of genomes each block covers.
+    """
+    size = matrix.shape[0]
+    if size <= max_dim:
+        return matrix
+    factor = -(-size // max_dim)  # ceiling division
+    nblocks = -(-size // factor)
+    pad = nblocks * factor - size
+    vals = np.pad(matrix.values.astype(float), ((0, pad), (0, pad)), mode="constant")
+    # Sum over each block, then divide by the count of real (unpadded)
+    # cells so that the trailing blocks are true means
+    sums = vals.reshape(nblocks, factor, nblocks, factor).sum(axis=(1, 3))
+    counts = np.full(nblocks, factor)
+    counts[-1] = factor - pad
+    labels = [
+        f"{matrix.index[idx]}..{matrix.index[min(idx + factor, size) - 1]}"
+        for idx in range(0, size, factor)
+    ]
+    return pd.DataFrame(sums / np.outer(counts, counts), index=labels, columns=labels)
+
+
 # Helper function that establishes whether dependencies are present
 # This caches the most recent result
 def has_dependencies() -> Dependencies:
@@ -47,6 +47,7 @@ print() statements will be caught by nosetests unless there is an
 error. They can also be recovered with the -s option.
 """
 
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
@@ -55,7 +56,7 @@ from typing import Dict, NamedTuple
 import pytest
 
 from pyani import pyani_config, pyani_graphics
-from pyani.pyani_tools import get_labels
+from pyani.pyani_tools import downsample_results_matrix, get_labels
 
 
 class GraphicsTestInputs(NamedTuple):
@@ -120,3 +121,28 @@ def test_svg_seaborn(graphics_inputs, tmp_path):
 def test_pdf_seaborn(graphics_inputs, tmp_path):
     """Write .pdf graphics with seaborn."""
     draw_format_method("pdf", "seaborn", graphics_inputs, tmp_path)
+
+
+def test_downsample_matrix():
+    """Block-average an oversized matrix down to the requested size."""
+    size = 11
+    names = [f"genome_{_}" for _ in range(size)]
+    df = pd.DataFrame(
+        np.arange(size * size, dtype=float).reshape(size, size),
+        index=names,
+        columns=names,
+    )
+    small = downsample_results_matrix(df, max_dim=4)
+    assert small.shape == (4, 4)
+    assert small.index[0] == "genome_0..genome_2"
+    assert small.index[-1] == "genome_9..genome_10"
+    # Full blocks and the ragged tail block are true means of their cells
+    assert small.iloc[0, 0] == pytest.approx(df.iloc[:3, :3].values.mean())
+    assert small.iloc[-1, -1] == pytest.approx(df.iloc[9:, 9:].values.mean())
+
+
+def test_downsample_matrix_within_limit():
+    """Return matrices within the size limit unchanged."""
+    names = ["genome_0", "genome_1"]
+    df = pd.DataFrame(np.eye(2), index=names, columns=names)
+    assert downsample_results_matrix(df, max_dim=2) is df